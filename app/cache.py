@@ -0,0 +1,76 @@
+"""Caches shared by the conversion endpoints."""
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread-safe mapping that keeps at most `maxsize` entries.
+
+    Once full, storing a new key evicts the least recently used one. The
+    endpoints only use it from the event loop, so the lock is never contended
+    there; it keeps the cache safe if it is ever handed to a worker thread.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def set(self, key, value) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+class SQLiteCache:
+    """Persistent mapping stored in the SQLite database at `path`.
+
+    Same `get`/`set` interface as `LRUCache`, but entries survive restarts and
+    are shared by every server process opening the same file. Keys must be
+    bytes and values strings. Nothing is evicted.
+
+    Calls block while another process holds the write lock (up to SQLite's
+    busy timeout), so async callers should make them from a worker thread.
+    The connection is opened on first use in each process: SQLite
+    connections must not cross a fork, e.g. under `gunicorn --preload`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        # Callers hold self._lock.
+        if self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            # WAL lets readers in other processes proceed while one of them writes.
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS d (k BLOB PRIMARY KEY, v TEXT NOT NULL)")
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._connection().execute("SELECT v FROM d WHERE k = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._connection().execute("INSERT OR REPLACE INTO d (k, v) VALUES (?, ?)", (key, value))
@@ -0,0 +1,77 @@
+"""Docling conversion, run inside the worker processes of a process pool.
+
+Each worker calls `init_worker()` once when it starts, so it builds its own
+DocumentConverters and keeps Docling's models loaded between jobs. The parent
+process only ever submits `convert()` to the pool.
+
+Docling is imported inside the functions below rather than at module level:
+the server process imports this module to reference them, and must not pay
+for loading docling and torch itself.
+"""
+import functools
+from pathlib import Path
+
+from app.options import BACKENDS, DOCLING_PAGE_BATCH_SIZE, Backend, pipeline_options
+
+
+@functools.lru_cache(maxsize=None)
+def _converter(backend: Backend):
+    """Return this worker's converter for `backend`, building it on first use.
+
+    Docling loads its layout/table/OCR models lazily on the first `convert()`
+    and caches them on the converter, so the converter must outlive a single
+    request for that cache to be of any use.
+    """
+    from docling.datamodel.base_models import InputFormat
+    from docling.document_converter import DocumentConverter, PdfFormatOption
+
+    pipeline_cls, options = pipeline_options(backend)
+    format_option = (
+        PdfFormatOption(pipeline_options=options)
+        if pipeline_cls is None
+        else PdfFormatOption(pipeline_cls=pipeline_cls, pipeline_options=options)
+    )
+    return DocumentConverter(
+        format_options={
+            InputFormat.IMAGE: format_option,
+            InputFormat.PDF: format_option
+        }
+    )
+
+
+def init_worker() -> None:
+    """Process-pool initializer: apply Docling settings and build converters.
+
+    Building a converter is cheap; models are only loaded by the first
+    conversion that needs them.
+    """
+    from docling.datamodel.settings import settings
+
+    settings.perf.page_batch_size = DOCLING_PAGE_BATCH_SIZE
+    for backend in BACKENDS:
+        _converter(backend)
+
+
+def convert(path: str, backend: Backend) -> tuple[str | None, str]:
+    """Convert the uploaded document stored at `path`.
+
+    Returns a pair `(md_path, markdown)`. For the "caption" backend the
+    markdown with pictures embedded as base64 data URIs is written next to
+    the input, inside the request's temporary directory, and `md_path`
+    points at it; `markdown` is then the plain
+    export, which the caller falls back to if picture integration fails. For
+    the other backends there is nothing left to integrate, so `md_path` is
+    None and `markdown` is the final result.
+    """
+    from docling_core.types.doc import ImageRefMode
+
+    result = _converter(backend).convert(path)
+    if backend != "caption":
+        return None, result.document.export_to_markdown()
+
+    # No mkdir: if the request has already given up and removed its
+    # directory, failing here is better than leaving an orphaned file.
+    md_filename = Path(path).with_name(f"{result.input.file.stem}-with-images.md")
+    result.document.save_as_markdown(md_filename, image_mode=ImageRefMode.EMBEDDED)
+
+    return str(md_filename), result.document.export_to_markdown()
@@ -1,26 +1,152 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Response
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Request, Response
 from markitdown import MarkItDown, FileConversionException, UnsupportedFormatException
-import tempfile
 import os
+import tempfile
 import asyncio
-from pathlib import Path
-from docling.datamodel.base_models import InputFormat
-from docling.datamodel.pipeline_options import PdfPipelineOptions
+import anyio
+import anyio.to_thread
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+
+import importlib.util
+import hashlib
+import httpx
+
+from app import docling_worker
+from app.cache import LRUCache
+from app.options import DOCLING_DEVICE, DOCLING_NUM_THREADS, VLM_TIMEOUT, Backend
+from app.picture import DESCRIPTION_FAILED, PictureIntegration
+
+
+# Responses carry pre-encoded UTF-8 bytes, so the charset is stated explicitly.
+MARKDOWN_MEDIA_TYPE = "text/markdown; charset=utf-8"
+
+# Uploads are streamed to disk in chunks of this size rather than read whole.
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Final docling markdown, already UTF-8 encoded, keyed by backend and the
+# SHA-256 of the upload.
+MARKDOWN_CACHE = LRUCache(int(os.getenv("MARKDOWN_CACHE_SIZE", "64")))
+
+# Docling (and the torch stack behind it) is only imported inside the worker
+# processes, so the server itself just checks that it is installed.
+DOCLING_AVAILABLE = importlib.util.find_spec("docling") is not None
+
+# Docling conversions run in a pool of worker processes, each holding its own
+# converters, so they don't share the server's GIL. On a CPU-only setup the
+# pool defaults to as many workers as fit the cores at DOCLING_NUM_THREADS
+# threads each; with a GPU (or "auto") it defaults to one, since every worker
+# loads its own copy of the models. At most `CONVERT_CONCURRENCY` conversions
+# (by default one per worker) are in the pool at once, timed-out ones
+# included, so excess requests wait instead of piling up in the pool's queue.
+_DEFAULT_DOCLING_WORKERS = (
+    max(1, (os.cpu_count() or 1) // DOCLING_NUM_THREADS) if DOCLING_DEVICE == "cpu" else 1
+)
+DOCLING_WORKERS = int(os.getenv("DOCLING_WORKERS", str(_DEFAULT_DOCLING_WORKERS)))
+CONVERT_CONCURRENCY = int(os.getenv("CONVERT_CONCURRENCY", str(DOCLING_WORKERS)))
+
+# Seconds a docling conversion may run before the request fails with 504.
+CONVERT_TIMEOUT = float(os.getenv("CONVERT_TIMEOUT", "300"))
+
+# Threads in anyio's default thread limiter, per uvicorn worker. They carry
+# the markitdown endpoint, upload reads and spooling, and short file reads
+# such as `app.picture`'s; Docling conversions run in the process pool, so
+# these threads are mostly waiting on I/O and can be plentiful.
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", "64"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create the objects shared by every request and release them on shutdown.
+
+    - `app.state.markitdown`: one MarkItDown instance; it keeps no
+      per-conversion state, so its converter registry is built only once.
+    - `app.state.docling_pool` / `app.state.docling_semaphore`: the Docling
+      worker processes and the gate on submissions to them.
+    - `app.state.http`: the HTTP client for VLM requests. Its pooled
+      keep-alive connections are shared by every picture description; the
+      transport does not retry, so a dead VLM fails fast.
+
+    Also resizes anyio's default thread limiter, which every thread offload
+    here goes through (FastAPI's threadpool, `UploadFile.read`,
+    `anyio.open_file`, `app.picture`), from 40 to `THREAD_POOL_SIZE` tokens.
+    """
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREAD_POOL_SIZE
+    app.state.markitdown = MarkItDown()
+    app.state.docling_semaphore = asyncio.Semaphore(CONVERT_CONCURRENCY)
+    app.state.docling_pool = ProcessPoolExecutor(
+        max_workers=DOCLING_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=docling_worker.init_worker,
+    )
+    app.state.http = httpx.AsyncClient(
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+        timeout=VLM_TIMEOUT,
+    )
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+        app.state.docling_pool.shutdown(cancel_futures=True)
+
 
-from docling.document_converter import DocumentConverter, PdfFormatOption
-from docling_core.types.doc import PictureItem, TableItem, ImageRefMode
-from docling.datamodel.pipeline_options import (PdfPipelineOptions, PictureDescriptionApiOptions, granite_picture_description)
-import re
-import json
-import requests
+app = FastAPI(title="markitdown-fastapi-demo", lifespan=lifespan)
+
+
+async def _spool_upload(file: UploadFile, path: str) -> str:
+    """Stream `file` to `path`, one chunk at a time.
+
+    Returns the SHA-256 hex digest of the content, computed as the chunks go
+    by. The upload is never held in memory as a whole, and only its path has
+    to cross over to a Docling worker process.
+    """
+    hasher = hashlib.sha256()
+    # Writes go through anyio's worker threads, so the event loop keeps
+    # serving other requests between chunks of a large upload.
+    async with await anyio.open_file(path, "wb") as out:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+            await out.write(chunk)
+    return hasher.hexdigest()
+
+
+async def _submit_conversion(state, upload_path: str, backend: Backend) -> tuple[str | None, str]:
+    """Run `docling_worker.convert` in the pool and wait up to `CONVERT_TIMEOUT`.
+
+    The semaphore slot is held until the worker actually finishes, not just
+    until this request stops waiting: a timed-out job keeps its worker busy,
+    and releasing early would let the next request queue behind it with its
+    own timeout already running. The timer starts once the slot is acquired.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = state.docling_semaphore
+    await semaphore.acquire()
+    try:
+        future = state.docling_pool.submit(docling_worker.convert, upload_path, backend)
+    except BaseException:
+        semaphore.release()
+        raise
+
+    def _release(_):
+        # Runs on the pool's management thread; asyncio.Semaphore is not
+        # thread-safe, so hand the release back to the loop.
+        try:
+            loop.call_soon_threadsafe(semaphore.release)
+        except RuntimeError:
+            pass  # the loop has already closed at shutdown
 
+    future.add_done_callback(_release)
+    return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout=CONVERT_TIMEOUT)
 
-app = FastAPI(title="markitdown-fastapi-demo")
 
 @app.post("/convert_file_to_markdown_by_markitdown")
-async def convert_file_to_markdown_by_markitdown(file: UploadFile = File(...)):
+def convert_file_to_markdown_by_markitdown(request: Request, file: UploadFile = File(...)):
     """Accept a single uploaded file and convert it to Markdown using markitdown.
 
+    The conversion is entirely blocking, so this is a plain `def` endpoint that
+    FastAPI runs in its threadpool instead of on the event loop.
+
     Returns a `text/markdown` response with the converted content.
     """
     # Basic validation
@@ -28,11 +154,11 @@ async def convert_file_to_markdown_by_markitdown(file: UploadFile = File(...)):
         raise HTTPException(status_code=400, detail="No filename provided")
 
     try:
-        converter = MarkItDown()
+        converter = request.app.state.markitdown
         # Use convert_stream which accepts a file-like object with .read()
         result = converter.convert_stream(file.file)
-        markdown = result.text_content if result is not None else ""
-        return Response(content=markdown, media_type="text/markdown")
+        body = result.text_content.encode("utf-8") if result is not None else b""
+        return Response(content=body, media_type=MARKDOWN_MEDIA_TYPE)
     except UnsupportedFormatException as e:
         raise HTTPException(status_code=415, detail=str(e))
     except FileConversionException as e:
@@ -43,244 +169,70 @@ async def convert_file_to_markdown_by_markitdown(file: UploadFile = File(...)):
 
 
 @app.post("/convert_file_to_markdown_by_docling")
-async def convert_file_to_markdown_by_docling(file: UploadFile = File(...)):
+async def convert_file_to_markdown_by_docling(
+    request: Request,
+    file: UploadFile = File(...),
+    backend: Backend = Query("vlm"),
+):
     """Accept an uploaded file and convert it to Markdown using Docling.
 
-    This endpoint writes the upload to a temporary file and calls Docling's
-    DocumentConverter.convert() in a thread so it doesn't block the event loop.
+    This endpoint streams the upload into a per-request temporary directory
+    and runs Docling's conversion on it in a worker process (see
+    `app.docling_worker`), so it neither blocks the event loop nor competes
+    with it for the GIL.
+
+    `backend` picks the pipeline (see `app.options`): `vlm` (the default)
+    transcribes each page once with the VLM, `caption` runs the layout
+    pipeline and replaces every embedded picture with a VLM description (see
+    `app.picture`), and `granite` runs the layout pipeline with
+    Docling's built-in Granite Vision picture descriptions.
     If `docling` isn't installed, returns 500 with an explanatory message.
     """
     if not file.filename:
         raise HTTPException(status_code=400, detail="No filename provided")
 
-    if DocumentConverter is None:
+    if not DOCLING_AVAILABLE:
         raise HTTPException(status_code=500, detail="docling is not installed in the virtual environment")
 
-    # Read upload into memory and write to a temp file
     try:
-        contents = await file.read()
-        suffix = Path(file.filename).suffix or ""
-        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
-        try:
-            tmp.write(contents)
-            tmp.flush()
-            tmp_path = tmp.name
-        finally:
-            tmp.close()
-       
-        
-
-        pipeline_options = PdfPipelineOptions()
-        pipeline_options.images_scale = 2.0
-        pipeline_options.generate_page_images = True
-        pipeline_options.generate_picture_images = True
-        
-        converter = DocumentConverter(
-            format_options={
-                InputFormat.IMAGE: PdfFormatOption(pipeline_options=pipeline_options),
-                InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_options)
-            }
-        )
-        # Run the potentially blocking conversion in a thread
-        result = await asyncio.to_thread(converter.convert, tmp_path)
-        
-        output_dir = Path("scratch")
-        output_dir.mkdir(parents=True, exist_ok=True)
-        doc_filename = result.input.file.stem
-        
-        md_filename = output_dir / f"{doc_filename}-with-images.md"
-        result.document.save_as_markdown(md_filename, image_mode=ImageRefMode.EMBEDDED)
-
-        markdown = ""
-        try:
-            integrated = PictureIntegration(str(md_filename))
-            markdown = integrated
-        except Exception:
-            # fallback to doc export
-            markdown = result.document.export_to_markdown()
-
-        # Clean up the intermediate markdown file if it was created
-        try:
-            if md_filename and md_filename.exists():
-                md_filename.unlink()
-        except Exception:
-            pass
-
-        return Response(content=markdown or "", media_type="text/markdown")
+        # Everything written for this request (the spooled upload and the
+        # worker's intermediate markdown) lives in one directory that is
+        # removed on every exit path, including a 504 while the worker runs.
+        with tempfile.TemporaryDirectory(prefix="docling_", ignore_cleanup_errors=True) as tmpdir:
+            # Docling picks the input format from the suffix; the rest of the
+            # client-supplied name is not needed and is not trusted as a path.
+            upload_path = os.path.join(tmpdir, "upload" + os.path.splitext(file.filename)[1])
+            digest = await _spool_upload(file, upload_path)
+            cache_key = f"{backend}:{digest}"
+            cached = MARKDOWN_CACHE.get(cache_key)
+            if cached is not None:
+                return Response(content=cached, media_type=MARKDOWN_MEDIA_TYPE)
+
+            state = request.app.state
+            try:
+                md_path, fallback = await _submit_conversion(state, upload_path, backend)
+            except asyncio.TimeoutError:
+                raise HTTPException(status_code=504, detail=f"Docling conversion timed out after {CONVERT_TIMEOUT:g}s")
+
+            if md_path is None:
+                body = fallback.encode("utf-8")
+                complete = True
+            else:
+                complete = False
+                try:
+                    body = await PictureIntegration(md_path, state.http)
+                    complete = DESCRIPTION_FAILED.encode("utf-8") not in body
+                except Exception:
+                    # fallback to doc export
+                    body = fallback.encode("utf-8")
+
+        # Only cache output where every picture was described, so a VLM
+        # outage doesn't pin placeholder text to this document.
+        if complete:
+            MARKDOWN_CACHE.set(cache_key, body)
+
+        return Response(content=body, media_type=MARKDOWN_MEDIA_TYPE)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Docling conversion failed: {str(e)}")
-    finally:
-        try:
-            os.unlink(tmp_path)
-        except Exception:
-            pass
-
-def vllm_local_options(model: str):
-    # 使用三引號來處理多行字串，這樣可以保持 Markdown 的格式
-    prompt_content = """# 檔案轉換需求：極致精確文字擷取與視覺分析
-
-請嚴格依序執行以下步驟，確保 **100% 擷取影像中所有文字**，並以繁體中文進行整合描述：
-
-## 執行步驟
-
-1. **極致文字掃描 (Strict Data Extraction)**：
-   全面掃描影像。擷取所有可見文字（包含標題、段落、註腳、標籤、按鈕、日期、標誌旁的微縮文字、甚至背景中的模糊文字）。**必須保留文字原始語言與書寫方式，禁止任何翻譯、改寫、拼字修正或刪減。**
-
-2. **全方位視覺建模 (Visual Detailing)**：
-   詳盡描述影像的視覺屬性，包括版面佈局（如欄位、框線、表格結構）、配色方案（色彩、光影、反差）、物體、材質紋理、圖示/標誌類型、以及前景與背景的空間關係。
-
-3. **強制作業：全文字核對與整合輸出**：
-   將步驟 1 擷取的「每一個」文字片段與步驟 2 的描述融合成一個專業的繁體中文段落。
-   * **核心要求**：此段落必須包含影像中出現的所有文字內容。文字必須以原始形式嵌入描述中，不得遺漏。
-   * **連結邏輯**：在描述視覺元素時，必須同時說明該處所呈現的文字內容（例如：在深藍色橫幅中印有白色加粗的「[原始文字]」字樣）。
-
-## 輸出要求（嚴格執行）
-
-* **單一整合段落**：僅輸出一個專業且連貫的**繁體中文**段落。該段落必須包含影像中所有擷取到的原始文字，且邏輯通順。
-* **Markdown 表格**：若影像包含表格，請在上述段落後立即輸出完整的 Markdown 表格。表格須完整呈現所有欄位與列，並保留表內文字的原始語言與書寫。
-* **禁令**：禁止輸出步驟標籤（如：步驟 1...）、禁止自我評論（如：這是一張...）、禁止標題、禁止額外說明或總結。"""
-
-    options = PictureDescriptionApiOptions(
-        url="http://localhost:11434/v1/chat/completions",
-        params=dict(
-            model=model,
-            seed=42,
-            temperature=0.0,  # 降低隨機性，讓描述更精確
-            max_completion_tokens=2048,
-        ),
-        prompt=prompt_content,
-        timeout=6000000,
-    )
-    return options
- 
-
-def PictureDescription(base64_image_str: str) -> str:
-    """Call local Ollama API to get a description for a base64 image string.
-
-    Uses the same prompt content as `vllm_local_options()` to ensure identical
-    prompt text. Returns the description text extracted from the Ollama response
-    or an error placeholder on failure.
-    """
-    
-    system_instruction = """
-    你是一個專業的圖像分析與文字擷取引擎。
-    任務：將圖片內容轉換為繁體中文描述。
-    規則：
-    1. 直接輸出結果，**嚴禁**重複用戶的指令或 Prompt。
-    2. **嚴禁**輸出「好的」、「這是圖片描述」等廢話。
-    3. 嚴格遵守 Markdown 格式輸出。
-    """
-
-    # 定義用戶的具體需求（User Prompt - 這裡只放具體執行細節）
-    user_prompt = """
-    # 執行步驟
-    1. 極致文字掃描：擷取所有可見文字，保留原始語言。
-    2. 全方位視覺建模：描述物品、色彩、結構。
-    3. 整合輸出：將所有文字與視覺描述融合成一個繁體中文段落。
-    
-    # 輸出格式
-    - 僅輸出一個整合段落。
-    - 若有表格，隨後附上 Markdown 表格。
-    
-    現在，請直接開始描述這張圖片：
-    """
-
-    url = "http://localhost:11434/v1/chat/completions"
-    payload = {
-        "model": "qwen3-vl:8b",
-        "messages": [
-            {
-                "role": "system",
-                "content": system_instruction
-            },
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": user_prompt},
-                    {"type": "image_url", "image_url": {"url": base64_image_str}},
-                ],
-            }
-        ],
-        "seed": 42,
-        "temperature": 0.0, # 保持 0.0 非常重要，避免模型「創意」地重複 Prompt
-        "max_tokens": -1, # Use model's max context length
-        "stream": False
-    }
-
-    try:
-        # No timeout (None) — allow the Ollama service as long as needed.
-        resp = requests.post(url, json=payload, timeout=None)
-        resp.raise_for_status()
-    except Exception as e:
-        return f"[PictureDescription failed: {str(e)}]"
-
-    try:
-        j = resp.json()
-    except Exception:
-        return resp.text
-
-    # Extract text from common response shapes
-    choices = j.get("choices") if isinstance(j, dict) else None
-    if choices and isinstance(choices, list) and len(choices) > 0:
-        first = choices[0]
-        # message.content may be string or list
-        msg = first.get("message") if isinstance(first, dict) else None
-        if isinstance(msg, dict):
-            content = msg.get("content")
-            if isinstance(content, str):
-                return content
-            if isinstance(content, list):
-                for item in content:
-                    if isinstance(item, dict) and item.get("type") == "text":
-                        text = item.get("text")
-                        if text:
-                            return text
-        text = first.get("text") if isinstance(first, dict) else None
-        if isinstance(text, str) and text.strip():
-            return text
-
-    if isinstance(j, dict):
-        for key in ("text", "output", "message", "description"):
-            val = j.get(key)
-            if isinstance(val, str) and val.strip():
-                return val
-
-    try:
-        return json.dumps(j)
-    except Exception:
-        return str(j)
-
-
-def PictureIntegration(md_filepath: str) -> str:
-    """Read a markdown file at `md_filepath`, find embedded images in the
-    form `![Image](data:image/...;base64,...)`, call `PictureDescription` for
-    each image and replace the image markdown with the returned description.
-
-    Returns the modified markdown content as a string.
-    """
-    p = Path(md_filepath)
-    if not p.exists():
-        raise FileNotFoundError(f"Markdown file not found: {md_filepath}")
-
-    # Read file content (try utf-8, fall back to default)
-    try:
-        text = p.read_text(encoding="utf-8")
-    except Exception:
-        text = p.read_text()
-
-    # Regex to capture the full data URI inside the image markdown
-    pattern = re.compile(r'!\[Image\]\((data:image/[^)]+)\)')
-
-    # For each match, call PictureDescription and replace with the description
-    def _replace(match: re.Match) -> str:
-        data_uri = match.group(1)
-        print(f"...{data_uri[-50:]}")
-        try:
-            desc = PictureDescription(data_uri)
-            # Ensure we always return a string
-            return desc if isinstance(desc, str) else str(desc)
-        except Exception as e:
-            return f"[PictureDescription failed: {str(e)}]"
-
-    new_text = pattern.sub(_replace, text)
-    return new_text
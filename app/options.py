@@ -0,0 +1,142 @@
+"""VLM prompts and Docling option factories for the conversion backends.
+
+Docling is imported inside the factories rather than at module level, so the
+server process can import the settings and prompts defined here without
+loading docling and torch; only the conversion workers call the factories.
+"""
+import functools
+import os
+from typing import Literal, get_args
+
+
+# Conversion backends accepted by the docling endpoint:
+#   vlm      - Docling's VlmPipeline transcribes each page once via Ollama.
+#   caption  - standard layout pipeline; embedded pictures are described
+#              afterwards by the endpoint (see PictureIntegration).
+#   granite  - standard layout pipeline with Docling's built-in picture
+#              description using the local Granite Vision model.
+Backend = Literal["vlm", "caption", "granite"]
+BACKENDS = get_args(Backend)
+
+# Seconds a single picture description request may take before it is
+# abandoned.
+VLM_TIMEOUT = float(os.getenv("VLM_TIMEOUT", "30"))
+
+# Seconds the "vlm" backend may spend transcribing one page. The whole page
+# comes back in one non-streamed response, so dense pages need far longer
+# than a picture description.
+PAGE_VLM_TIMEOUT = float(os.getenv("PAGE_VLM_TIMEOUT", "180"))
+
+# Device and CPU threads for Docling's layout/table/OCR models. "auto" picks
+# CUDA (or MPS) when available and falls back to the CPU.
+DOCLING_DEVICE = os.getenv("DOCLING_DEVICE", "auto")
+DOCLING_NUM_THREADS = int(os.getenv("DOCLING_NUM_THREADS", str(min(8, os.cpu_count() or 1))))
+
+# Pages fed to Docling's models per batch. Larger batches keep the threads
+# (or GPU) busy on long documents at the cost of more memory per worker.
+DOCLING_PAGE_BATCH_SIZE = int(os.getenv("DOCLING_PAGE_BATCH_SIZE", "8"))
+
+# Page-level VLM transcription prompt for the "vlm" backend.
+_PAGE_PROMPT = "將此頁面完整轉換為 Markdown。必須保留所有文字的原始語言與書寫方式，不得遺漏、翻譯或改寫；表格以 Markdown 表格輸出。僅輸出 Markdown 本身，禁止任何額外說明。"
+
+# Per-picture description prompt, shared by vllm_local_options() and the
+# endpoint's own PictureDescription() so both always send identical text.
+# 使用三引號來處理多行字串，這樣可以保持 Markdown 的格式
+PICTURE_PROMPT = """# 檔案轉換需求：極致精確文字擷取與視覺分析
+
+請嚴格依序執行以下步驟，確保 **100% 擷取影像中所有文字**，並以繁體中文進行整合描述：
+
+## 執行步驟
+
+1. **極致文字掃描 (Strict Data Extraction)**：
+   全面掃描影像。擷取所有可見文字（包含標題、段落、註腳、標籤、按鈕、日期、標誌旁的微縮文字、甚至背景中的模糊文字）。**必須保留文字原始語言與書寫方式，禁止任何翻譯、改寫、拼字修正或刪減。**
+
+2. **全方位視覺建模 (Visual Detailing)**：
+   詳盡描述影像的視覺屬性，包括版面佈局（如欄位、框線、表格結構）、配色方案（色彩、光影、反差）、物體、材質紋理、圖示/標誌類型、以及前景與背景的空間關係。
+
+3. **強制作業：全文字核對與整合輸出**：
+   將步驟 1 擷取的「每一個」文字片段與步驟 2 的描述融合成一個專業的繁體中文段落。
+   * **核心要求**：此段落必須包含影像中出現的所有文字內容。文字必須以原始形式嵌入描述中，不得遺漏。
+   * **連結邏輯**：在描述視覺元素時，必須同時說明該處所呈現的文字內容（例如：在深藍色橫幅中印有白色加粗的「[原始文字]」字樣）。
+
+## 輸出要求（嚴格執行）
+
+* **單一整合段落**：僅輸出一個專業且連貫的**繁體中文**段落。該段落必須包含影像中所有擷取到的原始文字，且邏輯通順。
+* **Markdown 表格**：若影像包含表格，請在上述段落後立即輸出完整的 Markdown 表格。表格須完整呈現所有欄位與列，並保留表內文字的原始語言與書寫。
+* **禁令**：禁止輸出步驟標籤（如：步驟 1...）、禁止自我評論（如：這是一張...）、禁止標題、禁止額外說明或總結。"""
+
+
+@functools.lru_cache(maxsize=None)
+def vllm_local_options(model: str):
+    from docling.datamodel.pipeline_options import PictureDescriptionApiOptions
+
+    options = PictureDescriptionApiOptions(
+        url="http://localhost:11434/v1/chat/completions",
+        params=dict(
+            model=model,
+            seed=42,
+            temperature=0.0,  # 降低隨機性，讓描述更精確
+            max_completion_tokens=2048,
+        ),
+        prompt=PICTURE_PROMPT,
+        timeout=VLM_TIMEOUT,
+    )
+    return options
+
+
+def ollama_vlm_options(model: str):
+    """VLM options that send each rendered page to the local Ollama server."""
+    from docling.datamodel.pipeline_options_vlm_model import ApiVlmOptions, ResponseFormat
+
+    return ApiVlmOptions(
+        url="http://localhost:11434/v1/chat/completions",
+        params=dict(
+            model=model,
+            seed=42,
+            temperature=0.0,
+        ),
+        prompt=_PAGE_PROMPT,
+        timeout=PAGE_VLM_TIMEOUT,
+        scale=1.0,
+        response_format=ResponseFormat.MARKDOWN,
+    )
+
+
+def accelerator_options():
+    """Accelerator settings shared by every backend's pipeline."""
+    from docling.datamodel.pipeline_options import AcceleratorDevice, AcceleratorOptions
+
+    return AcceleratorOptions(
+        num_threads=DOCLING_NUM_THREADS,
+        device=AcceleratorDevice(DOCLING_DEVICE),
+    )
+
+
+def pipeline_options(backend: Backend):
+    """Return `(pipeline_cls, pipeline_options)` for a conversion backend.
+
+    `pipeline_cls` is None for backends that use Docling's standard PDF
+    pipeline.
+    """
+    from docling.datamodel.pipeline_options import PdfPipelineOptions, VlmPipelineOptions, granite_picture_description
+    from docling.pipeline.vlm_pipeline import VlmPipeline
+
+    if backend == "vlm":
+        options = VlmPipelineOptions(enable_remote_services=True)
+        options.accelerator_options = accelerator_options()
+        options.vlm_options = ollama_vlm_options("qwen3-vl:8b")
+        return VlmPipeline, options
+
+    options = PdfPipelineOptions()
+    options.accelerator_options = accelerator_options()
+    # Only "caption" embeds picture images in its markdown; nothing reads page
+    # images, and Granite crops pictures from the page on its own.
+    options.images_scale = 2.0
+    options.generate_page_images = False
+    options.generate_picture_images = backend == "caption"
+    if backend == "granite":
+        options.do_picture_description = True
+        options.picture_description_options = granite_picture_description
+    elif backend != "caption":
+        raise ValueError(f"Unknown docling backend: {backend}")
+    return None, options
@@ -0,0 +1,294 @@
+"""Picture descriptions for the `caption` backend.
+
+Docling's markdown for that backend embeds every picture as a base64 data
+URI. `PictureIntegration` sends each distinct picture to the VLM through
+`PictureDescription` and splices the descriptions back into the markdown.
+"""
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import mmap
+import os
+import re
+import sqlite3
+from pathlib import Path
+
+import anyio
+import anyio.to_thread
+import httpx
+
+from app.cache import LRUCache, SQLiteCache
+from app.options import PICTURE_PROMPT, VLM_TIMEOUT
+
+
+logger = logging.getLogger(__name__)
+
+# Picture descriptions keyed by a hash of the image and the prompt. Kept in
+# memory unless DESCRIPTION_CACHE_PATH names an SQLite file, which then
+# persists them across restarts and shares them between server processes.
+_DESCRIPTION_CACHE_PATH = os.getenv("DESCRIPTION_CACHE_PATH")
+DESCRIPTION_CACHE = (
+    SQLiteCache(_DESCRIPTION_CACHE_PATH)
+    if _DESCRIPTION_CACHE_PATH
+    else LRUCache(int(os.getenv("DESCRIPTION_CACHE_SIZE", "4096")))
+)
+
+# Prefix of the placeholder returned when a picture could not be described.
+DESCRIPTION_FAILED = "[PictureDescription failed"
+
+# Picture descriptions requested in parallel per document.
+VLM_CONCURRENCY = int(os.getenv("VLM_CONCURRENCY", "4"))
+
+
+async def _run(fn, *args):
+    """Run `fn(*args)` in anyio's worker threads.
+
+    These are the same threads FastAPI uses, sized by `THREAD_POOL_SIZE`.
+    anyio copies the contextvars context for each call; sharing one bounded
+    pool is worth more than skipping that copy for a few file reads.
+    """
+    return await anyio.to_thread.run_sync(fn, *args)
+
+
+async def _cache_call(fn, *args):
+    """Call a `DESCRIPTION_CACHE` method without blocking the event loop.
+
+    The SQLite cache may wait on another process's write, so it runs in a
+    worker thread; the in-memory cache is called directly. The cache is best
+    effort: an SQLite error is logged and returns None, so a failed lookup is
+    a miss and a failed store is dropped rather than failing the picture.
+    """
+    if not isinstance(DESCRIPTION_CACHE, SQLiteCache):
+        return fn(*args)
+    try:
+        return await _run(fn, *args)
+    except sqlite3.Error as e:
+        logger.warning("Description cache %s failed: %s", fn.__name__, e)
+        return None
+
+
+_PICTURE_SYSTEM_PROMPT = """
+    你是一個專業的圖像分析與文字擷取引擎。
+    任務：將圖片內容轉換為繁體中文描述。
+    規則：
+    1. 直接輸出結果，**嚴禁**重複用戶的指令或 Prompt。
+    2. **嚴禁**輸出「好的」、「這是圖片描述」等廢話。
+    3. 嚴格遵守 Markdown 格式輸出。
+    """
+
+
+async def PictureDescription(base64_image_str: str, client: httpx.AsyncClient) -> str:
+    """Call local Ollama API to get a description for a base64 image string.
+
+    `client` is the shared `app.state.http` client, so requests reuse its
+    keep-alive connections. The completion is streamed and assembled as the
+    tokens arrive rather than buffered as one JSON document; the whole
+    request, stream included, is bounded by `VLM_TIMEOUT`.
+
+    Uses the same prompt content as `vllm_local_options()` (`PICTURE_PROMPT`)
+    to ensure identical prompt text. Returns the description text extracted
+    from the Ollama response or an error placeholder on failure. Successful
+    descriptions are cached in `DESCRIPTION_CACHE`; failures are not, so they
+    are retried next time.
+    """
+    
+    url = "http://localhost:11434/v1/chat/completions"
+    payload = {
+        "model": "qwen3-vl:8b",
+        "messages": [
+            {
+                "role": "system",
+                "content": _PICTURE_SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": PICTURE_PROMPT},
+                    {"type": "image_url", "image_url": {"url": base64_image_str}},
+                ],
+            }
+        ],
+        "seed": 42,
+        "temperature": 0.0, # 保持 0.0 非常重要，避免模型「創意」地重複 Prompt
+        "max_tokens": 2048, # Same cap as vllm_local_options(); -1 is unbounded
+        "stream": True
+    }
+
+    # Identical images under identical prompts get identical descriptions
+    # (seed and temperature are fixed), so skip the VLM on repeats.
+    hasher = hashlib.blake2b(digest_size=16)
+    for part in (payload["model"], _PICTURE_SYSTEM_PROMPT, PICTURE_PROMPT, base64_image_str):
+        hasher.update(part.encode("utf-8"))
+        hasher.update(b"\0")
+    key = hasher.digest()
+    cached = await _cache_call(DESCRIPTION_CACHE.get, key)
+    if cached is not None:
+        return cached
+
+    try:
+        # The client's timeout only bounds the gap between streamed chunks;
+        # this bounds the whole description.
+        with anyio.fail_after(VLM_TIMEOUT):
+            async with client.stream("POST", url, json=payload) as resp:
+                resp.raise_for_status()
+                if resp.headers.get("content-type", "").startswith("text/event-stream"):
+                    description = await _read_description_stream(resp)
+                else:
+                    await resp.aread()
+                    description = _extract_description(resp)
+        if not description.strip():
+            raise ValueError("VLM returned an empty description")
+    except TimeoutError:
+        return f"{DESCRIPTION_FAILED}: timed out after {VLM_TIMEOUT:g}s]"
+    except Exception as e:
+        return f"{DESCRIPTION_FAILED}: {str(e)}]"
+
+    await _cache_call(DESCRIPTION_CACHE.set, key, description)
+    return description
+
+
+def _raise_for_vlm_error(j) -> None:
+    """Raise if a (possibly 200) chat-completions body reports an error."""
+    if isinstance(j, dict) and j.get("error"):
+        raise ValueError(f"VLM error: {j['error']}")
+
+
+async def _read_description_stream(resp: httpx.Response) -> str:
+    """Accumulate the delta content of a streamed chat-completions response.
+
+    Raises if the server reports an error mid-stream or the stream ends
+    without `[DONE]`, so a truncated description is never returned.
+    """
+    parts = []
+    async for line in resp.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            break
+        chunk = json.loads(data)
+        _raise_for_vlm_error(chunk)
+        for choice in chunk.get("choices") or ():
+            content = (choice.get("delta") or {}).get("content")
+            if content:
+                parts.append(content)
+    else:
+        raise ValueError("VLM stream ended before [DONE]")
+    return "".join(parts)
+
+
+def _extract_description(resp: httpx.Response) -> str:
+    """Pull the description text out of a non-streamed chat-completions
+    response."""
+    try:
+        j = resp.json()
+    except Exception:
+        return resp.text
+    _raise_for_vlm_error(j)
+
+    # Extract text from common response shapes
+    choices = j.get("choices") if isinstance(j, dict) else None
+    if choices and isinstance(choices, list) and len(choices) > 0:
+        first = choices[0]
+        # message.content may be string or list
+        msg = first.get("message") if isinstance(first, dict) else None
+        if isinstance(msg, dict):
+            content = msg.get("content")
+            if isinstance(content, str):
+                return content
+            if isinstance(content, list):
+                for item in content:
+                    if isinstance(item, dict) and item.get("type") == "text":
+                        text = item.get("text")
+                        if text:
+                            return text
+        text = first.get("text") if isinstance(first, dict) else None
+        if isinstance(text, str) and text.strip():
+            return text
+
+    if isinstance(j, dict):
+        for key in ("text", "output", "message", "description"):
+            val = j.get(key)
+            if isinstance(val, str) and val.strip():
+                return val
+
+    try:
+        return json.dumps(j)
+    except Exception:
+        return str(j)
+
+
+# Regex to capture the full data URI inside the image markdown. It runs over
+# the raw bytes of the mapped file, so the pattern is a bytes pattern.
+_MD_IMAGE_RE = re.compile(rb'!\[Image\]\((data:image/[^)]+)\)')
+
+
+def _find_images(md_filepath: str) -> list[bytes]:
+    """Return the distinct image data URIs in `md_filepath`, in order."""
+    with open(md_filepath, "rb") as f:
+        # mmap refuses empty files.
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # Documents without pictures skip the regex scan entirely.
+            if mm.find(b"data:image/") == -1:
+                return []
+            return list(dict.fromkeys(_MD_IMAGE_RE.findall(mm)))
+
+
+def _splice_descriptions(md_filepath: str, descriptions: dict[bytes, bytes]) -> bytes:
+    """Copy `md_filepath` with every image replaced by its description.
+
+    The input is mapped rather than read, so only the output (in which the
+    base64 payloads have already been dropped) is built up in memory.
+    """
+    out = io.BytesIO()
+    with open(md_filepath, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        last = 0
+        for match in _MD_IMAGE_RE.finditer(mm):
+            out.write(mm[last:match.start()])
+            out.write(descriptions[match.group(1)])
+            last = match.end()
+        out.write(mm[last:])
+    return out.getvalue()
+
+
+async def PictureIntegration(md_filepath: str, client: httpx.AsyncClient) -> bytes:
+    """Read a markdown file at `md_filepath`, find embedded images in the
+    form `![Image](data:image/...;base64,...)`, call `PictureDescription` for
+    each image and replace the image markdown with the returned description.
+    Distinct images are described concurrently over `client`, at most
+    `VLM_CONCURRENCY` at a time; repeated images are described once.
+
+    Returns the modified markdown content, UTF-8 encoded.
+    """
+    data_uris = await _run(_find_images, md_filepath)
+    if not data_uris:
+        return await _run(Path(md_filepath).read_bytes)
+
+    # Describe each distinct image once, several at a time, then substitute
+    # the descriptions in a single pass.
+    semaphore = asyncio.Semaphore(VLM_CONCURRENCY)
+
+    async def _describe(data_uri: bytes) -> bytes:
+        async with semaphore:
+            try:
+                desc = await PictureDescription(data_uri.decode("ascii"), client)
+                # Ensure we always return a string
+                desc = desc if isinstance(desc, str) else str(desc)
+            except Exception as e:
+                desc = f"{DESCRIPTION_FAILED}: {str(e)}]"
+            return desc.encode("utf-8")
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Describing %d picture(s) in %s: %s",
+            len(data_uris), md_filepath, ", ".join(f"...{uri[-50:].decode('ascii')}" for uri in data_uris),
+        )
+
+    results = await asyncio.gather(*(_describe(uri) for uri in data_uris))
+    descriptions = dict(zip(data_uris, results))
+
+    return await _run(_splice_descriptions, md_filepath, descriptions)